@@ -1,52 +1,76 @@
-import argparse
+import functools
+import itertools
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from math import floor
 from pathlib import Path
+from typing import Literal
 
-import qrcode
+import numpy as np
+import segno
+import tyro
 
-from solid2 import cube, cylinder, hull, text, set_global_fn, union
+from solid2 import color, cylinder, hull, square, text, set_global_fn, union
+from solid2.config import config
 
 
 @dataclass
 class Args:
-    start_index: int
-    end_index: int
-    output_dir: Path = Path("output")
-    token_width: float = 50.0
-    token_height: float = 60.0
-    token_depth: float = 3.0
-    token_corner_radius: float = 4.0
-    token_fillet_radius: float = 1.0
-    qr_border: float = 3.0
-    colored_print_depth: float = 0.6
-    text_font: str = "Helvetica"
-    text_size: float = 7.0
-    text_border: float = 3.0
-    hole_radius: float = 3.0
-    hole_offset: float = 3.0
-    build_plate_width: float = 254.0
-    build_plate_height: float = 254.0
-    build_plate_spacing: float = 1.0
-
-
-def qr_code_to_3d_model(data: str, qr_width: int, depth: float) -> cube:
-    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, version=1, border=0)
-    qr.add_data(data)
-    # noinspection PyArgumentEqualDefault
-    qr.make()
-    matrix = qr.get_matrix()
+    start_index: int  # Starting index for keychain tags
+    end_index: int  # Ending index for keychain tags
+    output_dir: Path = Path("output")  # Output directory for STL files
+    token_width: float = 50.0  # Width of the keychain token
+    token_height: float = 60.0  # Height of the keychain token
+    token_depth: float = 3.0  # Depth of the keychain token
+    token_corner_radius: float = 4.0  # Corner radius of the keychain token
+    token_fillet_radius: float = 1.0  # Fillet radius of the keychain token
+    qr_border: float = 3.0  # Border width around the QR code
+    colored_print_depth: float = 0.6  # Depth of colored print
+    text_font: str = "Helvetica"  # Font for the text
+    text_size: float = 7.0  # Size of the text
+    text_border: float = 3.0  # Border around the text
+    hole_radius: float = 3.0  # Radius of the keychain hole
+    hole_offset: float = 3.0  # Offset of the keychain hole
+    cylinder_segments: int = 32  # Number of facets used for the token corners and keychain hole
+    build_plate_width: float = 254.0  # Width of the build plate
+    build_plate_height: float = 254.0  # Height of the build plate
+    build_plate_spacing: float = 1.0  # Spacing between keychains on the build plate
+    openscad_backend: Literal["manifold", "cgal"] | None = None  # OpenSCAD geometry backend for STL export
+
+
+@dataclass
+class TileDescriptor:
+    plate_index: int
+    tag_text: str
+    x_offset: float
+    y_offset: float
+
+
+def qr_runs(matrix: tuple[bytearray, ...]) -> list[tuple[int, int, int]]:
+    cells = np.frombuffer(b"".join(matrix), dtype=np.uint8).reshape(len(matrix), -1).astype(np.int8)
+    edges = np.diff(np.pad(cells, ((0, 0), (1, 1))), axis=1)
+    ys, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return list(zip(starts.tolist(), ys.tolist(), (ends - starts).tolist()))
+
+
+def qr_code_to_3d_model(data: str, qr_width: int, depth: float) -> color:
+    qr = segno.make_qr(data, error="h", boost_error=False)
+    matrix = qr.matrix
     num_cells = len(matrix)
 
     pixel_size = qr_width / num_cells
 
-    model = union()
-    for y, row in enumerate(matrix):
-        for x, cell in enumerate(row):
-            if cell:
-                model += cube(pixel_size, pixel_size, depth).right(x * pixel_size).forward(y * pixel_size)
+    squares = [
+        square([pixel_size * length, pixel_size]).translate([x * pixel_size, y * pixel_size])
+        for x, y, length in qr_runs(matrix)
+    ]
 
-    return model.color("black")
+    return union()(*squares).linear_extrude(height=depth).color("black")
 
 
 def create_keychain_body(
@@ -56,9 +80,9 @@ def create_keychain_body(
     radius: float,
     hole_radius: float,
     hole_offset: float,
+    segments: int,
 ):
-    main_core = cube([width - 2 * radius, height - 2 * radius, depth]).right(radius).forward(radius)
-    corner_cylinder = cylinder(r=radius, h=depth)
+    corner_cylinder = cylinder(r=radius, h=depth, _fn=segments)
 
     corners = [
         corner_cylinder.right(radius).forward(radius),
@@ -67,19 +91,10 @@ def create_keychain_body(
         corner_cylinder.right(radius).forward(height - radius),
     ]
 
-    rounded_edges = [
-        hull()(corners[0], corners[1]),
-        hull()(corners[1], corners[2]),
-        hull()(corners[2], corners[3]),
-        hull()(corners[3], corners[0]),
-    ]
-
-    combined_shape = main_core
-    for shape in rounded_edges:
-        combined_shape += shape
+    combined_shape = hull()(*corners)
 
     keychain_hole = (
-        cylinder(r=hole_radius, h=depth + 2)
+        cylinder(r=hole_radius, h=depth + 2, _fn=segments)
         .right(width - hole_offset - hole_radius)
         .forward(height - hole_offset - (hole_radius * 2))
         .back(-1)
@@ -98,120 +113,144 @@ def add_text(data: str, size: float, depth):
 
 
 def parse_args() -> Args:
-    parser = argparse.ArgumentParser(description="Create keychain models")
-    parser.add_argument("--start-index", type=int, help="Starting index for keychain tags", required=True)
-    parser.add_argument("--end-index", type=int,  help="Ending index for keychain tags", required=True)
-    parser.add_argument("--output-dir", type=Path, default=Args.output_dir, help="Output directory for 3mf files")
-    parser.add_argument("--token-width", type=float, default=Args.token_width, help="Width of the keychain token")
-    parser.add_argument("--token-height", type=float, default=Args.token_height, help="Height of the keychain token")
-    parser.add_argument("--token-depth", type=float, default=Args.token_depth, help="Depth of the keychain token")
-    parser.add_argument(
-        "--token-corner-radius",
-        type=float,
-        default=Args.token_corner_radius,
-        help="Corner radius of the keychain token",
-    )
-    parser.add_argument(
-        "--token-fillet-radius", type=float, default=Args.token_fillet_radius, help="Filet radius of the keychain token"
-    )
-    parser.add_argument("--qr-border", type=float, default=Args.qr_border, help="Border width around the QR code")
-    parser.add_argument(
-        "--colored-print-depth", type=float, default=Args.colored_print_depth, help="Depth of colored print"
-    )
-    parser.add_argument("--text-font", type=str, default=Args.text_font, help="Font for the text")
-    parser.add_argument("--text-size", type=float, default=Args.text_size, help="Size of the text")
-    parser.add_argument("--text-border", type=float, default=Args.text_border, help="Border around the text")
-    parser.add_argument("--hole-radius", type=float, default=Args.hole_radius, help="Radius of the keychain hole")
-    parser.add_argument("--hole-offset", type=float, default=Args.hole_offset, help="Offset of the keychain hole")
-    return Args(**vars(parser.parse_args()))
+    return tyro.cli(Args, description="Create keychain models")
+
+
+def save_as_binary_stl(model: union, stl_path: Path, backend: Literal["manifold", "cgal"] | None = None) -> None:
+    with tempfile.TemporaryDirectory() as scad_dir:
+        scad_path = Path(scad_dir) / stl_path.with_suffix(".scad").name
+        model.save_as_scad(scad_path)
+        command = shlex.split(
+            config.openscad_stl_command.format(scadfile=shlex.quote(str(scad_path)), stlfile=shlex.quote(str(stl_path)))
+        )
+        command += ["--export-format", "binstl"]
+        if backend is not None:
+            command.append(f"--backend={backend}")
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"OpenSCAD failed to render {stl_path}: {result.stderr.strip()}")
 
 
 def prepare_output_directory(output_dir: Path) -> None:
-    for file in output_dir.glob("*"):
-        file.unlink()
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
 
-def generate_plate() -> None:
-    args = parse_args()
-    prepare_output_directory(args.output_dir)
-    set_global_fn(100)
-
+def build_tile_descriptors(args: Args) -> list[TileDescriptor]:
     num_per_row = int(args.build_plate_width / (args.token_width + args.build_plate_spacing))
     num_per_column = int(args.build_plate_height / (args.token_height + args.build_plate_spacing))
     tokens_per_plate = num_per_row * num_per_column
 
-    current_plate_index = 0
-    build_plate_body = union()
-    build_plate_colored = union()
+    descriptors = []
     for i in range(args.start_index, args.end_index + 1):
-        if (i - args.start_index) % tokens_per_plate == 0:
-            if current_plate_index > 0:
-                build_plate_body.save_as_stl(args.output_dir / f"build_plate_body_{current_plate_index}.stl")
-                build_plate_colored.save_as_stl(args.output_dir / f"build_plate_colored_{current_plate_index}.stl")
-
-            build_plate_body = union()
-            build_plate_colored = union()
-            current_plate_index += 1
-
-        tag_text = f"T-{i}"
-        qr_model = qr_code_to_3d_model(
-            tag_text, qr_width=floor(args.token_width - (args.qr_border * 2)), depth=args.colored_print_depth
+        plate_index, position_index = divmod(i - args.start_index, tokens_per_plate)
+        row, col = divmod(position_index, num_per_row)
+        descriptors.append(
+            TileDescriptor(
+                plate_index=plate_index + 1,
+                tag_text=f"T-{i}",
+                x_offset=col * (args.token_width + args.build_plate_spacing),
+                y_offset=row * (args.token_height + args.build_plate_spacing),
+            )
         )
-        text_model = add_text(tag_text, args.text_size, args.colored_print_depth)
-
-        position_index = (i - args.start_index) % tokens_per_plate
-        row = position_index // num_per_row
-        col = position_index % num_per_row
-        x_offset = col * (args.token_width + args.build_plate_spacing)
-        y_offset = row * (args.token_height + args.build_plate_spacing)
+    return descriptors
 
-        colored = assemble_colored_components(
-            qr_model, text_model, args, (args.token_width - args.hole_radius - args.text_border) / 2
-        )
-        body = create_keychain_body(
-            args.token_width,
-            args.token_height,
-            args.token_depth - 0.00001,
-            args.token_corner_radius,
-            args.hole_radius,
-            args.hole_offset,
-        )
-        body -= colored
 
-        positioned_body = body.translate([x_offset, y_offset, 0])
-        positioned_colored = colored.translate([x_offset, y_offset, 0])
+def build_tile(tile: TileDescriptor, args: Args, base_body: union, qr_width: int) -> tuple[union, union]:
+    qr_model = qr_code_to_3d_model(tile.tag_text, qr_width=qr_width, depth=args.colored_print_depth)
+    text_model = add_text(tile.tag_text, args.text_size, args.colored_print_depth)
 
-        build_plate_body += positioned_body
-        build_plate_colored += positioned_colored
+    colored = assemble_colored_components(
+        qr_model, text_model, args, (args.token_width - args.hole_radius - args.text_border) / 2
+    )
+    body = base_body - colored
+
+    positioned_body = body.translate([tile.x_offset, tile.y_offset, 0])
+    positioned_colored = colored.translate([tile.x_offset, tile.y_offset, 0])
+    return positioned_body, positioned_colored
+
+
+def save_plate(
+    executor: ThreadPoolExecutor, bodies: list[union], colored_parts: list[union], plate_index: int, args: Args
+) -> list[Future]:
+    return [
+        executor.submit(
+            save_as_binary_stl,
+            union()(*bodies),
+            args.output_dir / f"build_plate_body_{plate_index}.stl",
+            args.openscad_backend,
+        ),
+        executor.submit(
+            save_as_binary_stl,
+            union()(*colored_parts),
+            args.output_dir / f"build_plate_colored_{plate_index}.stl",
+            args.openscad_backend,
+        ),
+    ]
 
-    if current_plate_index > 0:
-        build_plate_body.save_as_stl(args.output_dir / f"build_plate_body_{current_plate_index}.stl")
-        build_plate_colored.save_as_stl(args.output_dir / f"build_plate_colored_{current_plate_index}.stl")
 
-    for file in args.output_dir.glob("*.scad"):
-        file.unlink()
+def generate_plate() -> None:
+    args = parse_args()
+    prepare_output_directory(args.output_dir)
+    set_global_fn(100)
 
+    base_body = create_keychain_body(
+        args.token_width,
+        args.token_height,
+        args.token_depth - 0.00001,
+        args.token_corner_radius,
+        args.hole_radius,
+        args.hole_offset,
+        args.cylinder_segments,
+    )
 
-def assemble_colored_components(qr_model: cube, text_model: union, args: Args, text_offset: float) -> union:
-    front_colored = qr_model.right(args.qr_border).forward(args.qr_border).up(
-        args.token_depth - args.colored_print_depth
-    ) + text_model.right(text_offset).forward(args.token_height - args.text_border).up(
-        args.token_depth - args.colored_print_depth
+    qr_width = int(args.token_width - (args.qr_border * 2))
+
+    build = functools.partial(build_tile, args=args, base_body=base_body, qr_width=qr_width)
+    render_jobs = []
+    max_workers = os.cpu_count() or 1
+    with (
+        ProcessPoolExecutor(max_workers=max_workers) as executor,
+        ThreadPoolExecutor(max_workers=max_workers) as render_executor,
+    ):
+        for plate_index, plate_tiles in itertools.groupby(
+            build_tile_descriptors(args), key=lambda tile: tile.plate_index
+        ):
+            plate_tiles = list(plate_tiles)
+            chunksize = max(1, len(plate_tiles) // (8 * max_workers))
+            positioned_tiles = list(executor.map(build, plate_tiles, chunksize=chunksize))
+            bodies = [positioned_body for positioned_body, _ in positioned_tiles]
+            colored_parts = [positioned_colored for _, positioned_colored in positioned_tiles]
+
+            render_jobs += save_plate(render_executor, bodies, colored_parts, plate_index, args)
+            while len(render_jobs) > 2 * max_workers:
+                render_jobs.pop(0).result()
+
+    for job in render_jobs:
+        job.result()
+
+
+def assemble_colored_components(qr_model: color, text_model: color, args: Args, text_offset: float) -> union:
+    colored_z = args.token_depth - args.colored_print_depth
+    text_y = args.token_height - args.text_border
+
+    front_colored = qr_model.translate([args.qr_border, args.qr_border, colored_z]) + text_model.translate(
+        [text_offset, text_y, colored_z]
     )
 
     back_colored = (
-        qr_model.left(args.token_width - args.qr_border).forward(args.qr_border).mirrorX()
-        + text_model.left(text_offset).forward(args.token_height - args.text_border).mirrorX()
-    )
+        qr_model.translate([args.qr_border - args.token_width, args.qr_border, 0])
+        + text_model.translate([-text_offset, text_y, 0])
+    ).mirrorX()
 
     return front_colored + back_colored
 
 
 def save_models(body: union, colored: union, index: int, output_dir: Path) -> None:
     body -= colored
-    body.save_as_stl(output_dir / f"keychain_{index}.stl")
-    colored.save_as_stl(output_dir / f"keychain_{index}_colored.stl")
+    save_as_binary_stl(body, output_dir / f"keychain_{index}.stl")
+    save_as_binary_stl(colored, output_dir / f"keychain_{index}_colored.stl")
 
 
 if __name__ == "__main__":